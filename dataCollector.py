@@ -1,21 +1,52 @@
 import requests
+import json
+import orjson
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 import sqlite3
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 import time
 import logging
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared insert statements; sqlite3 caches compiled statements by SQL text, so INS_RAW is prepared once
+INS_RAW = "INSERT INTO raw_prices (timestamp, symbol, price) VALUES (?, ?, ?)"
+INS_DOWNSAMPLED = '''
+    INSERT INTO downsampled_prices 
+    (date, hour, symbol, open_price, high_price, low_price, 
+     close_price, avg_price, sample_count)
+    VALUES %s
+'''
 
 
 class DataCollector:
     def __init__(self):
         self.symbols = ["BTCUSDT", "ETHUSDT", "LTCBTC"]
         self.sampling_frequency = 5 #wait time in seconds
+        self.request_timeout = 5 #seconds
         self.base_url = "https://api.binance.com/api/v3/ticker/price"
+        # Symbols still sampled; ones Binance reports as invalid are dropped the first time they're found
+        self.active_symbols = list(self.symbols)
+        # One bulk ticker request covers every symbol; only rebuilt when the symbol set changes
+        self.prices_url = self.build_prices_url()
+        # Per-symbol URLs, used only when Binance rejects the bulk request
+        self.symbol_urls = {symbol: f"{self.base_url}?symbol={symbol}" for symbol in self.symbols}
+
+        # Shared HTTP session so connections are kept alive between ticks
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+        # Raw rows for the current hour, flushed to SQLite at the hour boundary
+        self.raw_buffer: List[tuple] = []
+        # Hourly rows from a failed PostgreSQL write, retried once with the next hour
+        self.retry_rows: List[tuple] = []
 
         self.running_metrics = {
             symbol: {
@@ -29,14 +60,20 @@ class DataCollector:
             } for symbol in self.symbols
         }
 
-        self.postgres_conn = psycopg2.connect(
+        # Pooled connections: broken ones are discarded and transparently reopened
+        self.pg_pool = ThreadedConnectionPool(
+            1, 4,
             dbname="crypto_data",
             user="default",  # Configure the username
             password="",     #Configire the password here
             host="localhost",
-            port="5432"
+            port="5432",
+            # Hourly aggregates tolerate losing the last commit on a server crash; skip the WAL fsync wait
+            options="-c synchronous_commit=off"
         )
         self.setup_postgres()
+        # Hourly PostgreSQL writes run here so the sampling loop never waits on them
+        self.pg_writer = ThreadPoolExecutor(max_workers=1)
 
         self.sqlite_conn = sqlite3.connect('raw_data.db')
         self.setup_sqlite_db()
@@ -45,10 +82,24 @@ class DataCollector:
 
     def setup_sqlite_db(self):
         """Initialize SQLite database for raw data"""
+        # Append-only writes: WAL avoids the rollback journal and most fsyncs
+        self.sqlite_conn.execute("PRAGMA journal_mode=WAL")
+        self.sqlite_conn.execute("PRAGMA synchronous=NORMAL")
+        self.sqlite_conn.execute("PRAGMA temp_store=MEMORY")
+        self.sqlite_conn.execute("PRAGMA cache_size=-65536")
+
         cursor = self.sqlite_conn.cursor()
+        # Older databases stored ISO-string timestamps in a TEXT column; raw data is transient,
+        # so recreate the table instead of mixing epoch-ns values into it
+        cursor.execute("PRAGMA table_info(raw_prices)")
+        column_types = {column[1]: column[2].upper() for column in cursor.fetchall()}
+        if column_types.get('timestamp') == 'TEXT':
+            logger.info("Recreating raw_prices with epoch-ns INTEGER timestamps")
+            cursor.execute("DROP TABLE raw_prices")
+
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS raw_prices (
-                timestamp TEXT,
+                timestamp INTEGER,
                 symbol TEXT,
                 price REAL
             )
@@ -57,53 +108,116 @@ class DataCollector:
     
     
     def setup_postgres(self):
-        cursor = self.postgres_conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS downsampled_prices (
-                date DATE,
-                hour INTEGER,
-                symbol TEXT,
-                open_price REAL,
-                high_price REAL,
-                low_price REAL,
-                close_price REAL,
-                avg_price REAL,
-                sample_count INTEGER,
-                PRIMARY KEY (date, hour, symbol)
-            )
-        ''')
-
-        self.postgres_conn.commit()
+        conn = self.pg_pool.getconn()
+        try:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS downsampled_prices (
+                    date DATE,
+                    hour INTEGER,
+                    symbol TEXT,
+                    open_price REAL,
+                    high_price REAL,
+                    low_price REAL,
+                    close_price REAL,
+                    avg_price REAL,
+                    sample_count INTEGER,
+                    PRIMARY KEY (date, hour, symbol)
+                )
+            ''')
+
+            conn.commit()
+        finally:
+            self.pg_pool.putconn(conn)
     
 
     def update_running_metrics(self, symbol, price, timestamp):
         metrics = self.running_metrics[symbol]
+        high_price = metrics['high_price']
 
-        if not metrics['open_price']:
-            metrics['open_price'] = price
+        if high_price is None:
+            # First sample of the hour seeds open/high/low
+            metrics['open_price'] = metrics['high_price'] = metrics['low_price'] = price
+        elif price > high_price:
+            metrics['high_price'] = price
+        elif price < metrics['low_price']:
+            metrics['low_price'] = price
 
         metrics['latest_price'] = price
-        metrics['high_price'] = max(price, metrics['high_price']) if metrics['high_price'] is not None else price
-        metrics['low_price'] = min(price, metrics['low_price']) if metrics['low_price'] is not None else price
         metrics['latest_timestamp'] = timestamp
 
-        total_sum = metrics['avg_price']*metrics['sample_count']
-        total_sum += price
+        # Streaming mean: no re-scaling of the running sum on every sample
         metrics['sample_count'] += 1
-        metrics['avg_price'] = total_sum/metrics['sample_count']
+        metrics['avg_price'] += (price - metrics['avg_price']) / metrics['sample_count']
 
     
+    def build_prices_url(self) -> str:
+        """Bulk ticker URL for the active symbols"""
+        return f"{self.base_url}?symbols={quote(json.dumps(self.active_symbols, separators=(',', ':')))}"
+
+
+    def fetch_prices_per_symbol(self) -> Tuple[Dict[str, str], List[str]]:
+        """Fetch each symbol's price with its own request; returns prices and rejected symbols"""
+        prices = {}
+        invalid_symbols = []
+        for symbol in self.active_symbols:
+            try:
+                response = self.session.get(self.symbol_urls[symbol], timeout=self.request_timeout)
+                if response.status_code == 400:
+                    invalid_symbols.append(symbol)
+                response.raise_for_status()
+                prices[symbol] = orjson.loads(response.content)['price']
+            except Exception as e:
+                logger.error(f"Error fetching price for {symbol}: {str(e)}")
+        return prices, invalid_symbols
+
+
+    def drop_invalid_symbols(self, invalid_symbols: List[str]):
+        """Stop requesting symbols Binance rejected, so later ticks go back to one bulk request"""
+        if not invalid_symbols:
+            # No single symbol explains the rejection; stop sending a bulk request that keeps failing
+            logger.error("Bulk price request rejected for valid symbols, switching to per-symbol requests")
+            self.prices_url = None
+            return
+
+        logger.error(f"Dropping invalid symbols from sampling: {', '.join(invalid_symbols)}")
+        self.active_symbols = [symbol for symbol in self.active_symbols if symbol not in invalid_symbols]
+        self.prices_url = self.build_prices_url() if self.active_symbols else None
+
+
     def fetch_prices(self) -> List[Dict]:
         """Fetch current prices for all symbols"""
+        try:
+            if self.prices_url is None:
+                prices, _ = self.fetch_prices_per_symbol()
+            else:
+                response = self.session.get(self.prices_url, timeout=self.request_timeout)
+                if response.status_code == 400:
+                    # Binance rejects the whole bulk request if any one symbol is invalid
+                    logger.warning("Bulk price request rejected (HTTP 400), checking symbols individually")
+                    prices, invalid_symbols = self.fetch_prices_per_symbol()
+                    self.drop_invalid_symbols(invalid_symbols)
+                else:
+                    response.raise_for_status()
+                    # Decode the raw bytes directly; skips requests' text decoding and stdlib json
+                    prices = {ticker['symbol']: ticker['price'] for ticker in orjson.loads(response.content)}
+                    for symbol in self.active_symbols:
+                        if symbol not in prices:
+                            logger.error(f"Error fetching price for {symbol}: missing from bulk response")
+        except Exception as e:
+            logger.error(f"Error fetching prices: {str(e)}")
+            return []
+
+        # All symbols come from the same response, so stamp them with one clock read (epoch ns)
+        timestamp = time.time_ns()
         results = []
-        for symbol in self.symbols:
+        for symbol in self.active_symbols:
+            # Symbols without a price were already logged where the fetch failed
+            if symbol not in prices:
+                continue
             try:
-                response = requests.get(f"{self.base_url}?symbol={symbol}")
-                response.raise_for_status()
-                data = response.json()
-                price = float(data['price'])
-                timestamp = datetime.now()
+                price = float(prices[symbol])
 
                 self.update_running_metrics(symbol, price, timestamp)
 
@@ -118,49 +232,91 @@ class DataCollector:
     
 
     def store_raw_data(self, raw_data: List[Dict]):
-        """Store raw cryto data in SQLite"""
-        cursor = self.sqlite_conn.cursor()
-        for entry in raw_data:
-            cursor.execute(
-                "INSERT INTO raw_prices (timestamp, symbol, price) VALUES (?, ?, ?)",
-                (entry['timestamp'].isoformat(), entry['symbol'], entry['price'])
-            )
+        """Buffer raw cryto data in memory until the next flush to SQLite"""
+        self.raw_buffer.extend(
+            (entry['timestamp'], entry['symbol'], entry['price']) for entry in raw_data
+        )
+
+
+    def flush_raw_data(self):
+        """Write buffered raw data to SQLite in a single transaction"""
+        if not self.raw_buffer:
+            return
+        self.sqlite_conn.executemany(INS_RAW, self.raw_buffer)
         self.sqlite_conn.commit()
+        self.raw_buffer = []
     
     def clear_raw_data(self):
         """Clear raw data from SQLite at EOD"""
         cursor = self.sqlite_conn.cursor()
         cursor.execute("DELETE FROM raw_prices")
         self.sqlite_conn.commit()
+        self.sqlite_conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
 
         logger.info("Cleared Raw Price Data")
 
     
 
-    def store_downsampled_data(self, hour_datetime: datetime):
-        pg_cursor = self.postgres_conn.cursor()
-
-        for symbol, metrics in self.running_metrics.items():
-            if metrics['sample_count'] > 0:
-
-                pg_cursor.execute('''
-                    INSERT INTO downsampled_prices 
-                    (date, hour, symbol, open_price, high_price, low_price, 
-                     close_price, avg_price, sample_count)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ''', (
-                    hour_datetime.date(),
-                    hour_datetime.hour,
-                    symbol,
-                    metrics['open_price'],
-                    metrics['high_price'],
-                    metrics['low_price'],
-                    metrics['latest_price'],
-                    metrics['avg_price'],
-                    metrics['sample_count']
-                ))
-        self.postgres_conn.commit()
-        logger.info(f"Stored Hourly Metrics for Hour {hour_datetime.hour}")
+    def store_downsampled_data(self, hour_datetime: datetime, running_metrics: Dict = None):
+        """Store an hour of metrics in PostgreSQL (defaults to the live running metrics)"""
+        if running_metrics is None:
+            running_metrics = self.running_metrics
+
+        rows = [
+            (
+                hour_datetime.date(),
+                hour_datetime.hour,
+                symbol,
+                metrics['open_price'],
+                metrics['high_price'],
+                metrics['low_price'],
+                metrics['latest_price'],
+                metrics['avg_price'],
+                metrics['sample_count']
+            )
+            for symbol, metrics in running_metrics.items()
+            if metrics['sample_count'] > 0
+        ]
+
+        # Rows that already failed once get this one retry and are then dropped
+        retried_rows, self.retry_rows = self.retry_rows, []
+
+        conn = None
+        discard = False
+        try:
+            # Reconnects happen here, so a database that is still down is handled below
+            conn = self.pg_pool.getconn()
+            if retried_rows:
+                # Own transaction, so rows that fail for a data reason can't hold back this hour's rows
+                try:
+                    self.write_downsampled_rows(conn, retried_rows)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    logger.error(f"Dropping {len(retried_rows)} hourly rows that failed again: {str(e)}")
+                retried_rows = []
+
+            self.write_downsampled_rows(conn, rows)
+            logger.info(f"Stored Hourly Metrics for Hour {hour_datetime.hour}")
+        except psycopg2.Error as e:
+            logger.error(f"Error storing hourly metrics for hour {hour_datetime.hour}: {str(e)}")
+            if retried_rows:
+                logger.error(f"Dropping {len(retried_rows)} hourly rows that already failed once")
+            self.retry_rows = rows
+            # Only a broken connection is dropped; the pool opens a fresh one next time
+            discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        finally:
+            if conn is not None:
+                self.pg_pool.putconn(conn, close=discard)
+
+
+    def write_downsampled_rows(self, conn, rows: List[tuple]):
+        """Insert hourly rows with a single multi-row INSERT and commit them"""
+        pg_cursor = conn.cursor()
+        # Single multi-row INSERT instead of one round trip per symbol
+        execute_values(pg_cursor, INS_DOWNSAMPLED, rows, page_size=100)
+        conn.commit()
 
 
     def reset_running_metrics(self):
@@ -176,32 +332,56 @@ class DataCollector:
 
     
     
+    def hourly_rollover(self, hour_datetime: datetime):
+        """Close out a finished hour: store its metrics, reset them and flush raw data"""
+        # Hand the writer a copy; the live metrics are reset for the new hour below
+        snapshot = {symbol: dict(metrics) for symbol, metrics in self.running_metrics.items()}
+        future = self.pg_writer.submit(self.store_downsampled_data, hour_datetime, snapshot)
+        future.add_done_callback(lambda done: self.log_write_failure(done, hour_datetime))
+        self.reset_running_metrics()
+
+        self.flush_raw_data()
+        if hour_datetime.hour == 23:
+            self.clear_raw_data()
+
+
+    def log_write_failure(self, future: Future, hour_datetime: datetime):
+        """Log an exception raised by a background PostgreSQL write"""
+        if future.cancelled():
+            logger.error(f"Hourly metrics write for hour {hour_datetime.hour} was cancelled")
+        elif future.exception() is not None:
+            logger.error(f"Error storing hourly metrics for hour {hour_datetime.hour}: {str(future.exception())}")
+
+
+    def seconds_until_hour_end(self, hour_datetime: datetime) -> float:
+        """Wall-clock seconds left until the hour starting at hour_datetime ends"""
+        return (hour_datetime + timedelta(hours=1) - datetime.now()).total_seconds()
+
+    
     def run(self):
         try:
-            current_hour = datetime.now().hour
+            current_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+            # Ticks are scheduled on the monotonic clock so fetch/store time doesn't add drift
+            next_tick = time.monotonic()
+            # The hour boundary is scheduled once per hour instead of polling the wall clock every tick
+            next_rollover = next_tick + self.seconds_until_hour_end(current_hour)
             while True:
 
-                current_time = datetime.now()
-                
-                if current_time.hour != current_hour:
-                    previous_hour = current_time - timedelta(hours=1)
-                    previous_hour = previous_hour.replace(minute=0, second=0, microsecond=0)
-                    self.store_downsampled_data(previous_hour)
-                    self.reset_running_metrics()
-                    current_hour = current_time.hour
-
-                if current_time.hour == 0:
-                    self.clear_raw_data()
-
+                if next_tick >= next_rollover:
+                    self.hourly_rollover(current_hour)
+                    current_hour += timedelta(hours=1)
+                    next_rollover = time.monotonic() + self.seconds_until_hour_end(current_hour)
 
 
                 # Fetch and store prices
                 current_prices = self.fetch_prices()
                 self.store_raw_data(current_prices)
                 
-                # Log current prices
+                # Log current prices; every row of a tick shares one timestamp, so format it once
+                if current_prices:
+                    sampled_at = datetime.fromtimestamp(current_prices[0]['timestamp'] // 10**9)
                 for price_data in current_prices:
-                    logger.info(f"{price_data['symbol']}: ${price_data['price']:.2f} at {price_data['timestamp']}")
+                    logger.info(f"{price_data['symbol']}: ${price_data['price']:.2f} at {sampled_at}")
                 
                 
                 # # Optional Logging Statements to view the Running Metrics
@@ -217,12 +397,21 @@ class DataCollector:
                 #         )
                 
 
-                time.sleep(self.sampling_frequency)
+                next_tick += self.sampling_frequency
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Overran a whole period: skip the missed ticks instead of bursting
+                    next_tick = time.monotonic()
 
         except KeyboardInterrupt:
             logger.info("Stopping Data Ingestion...")
         finally:
-            self.postgres_conn.close()
+            self.session.close()
+            self.pg_writer.shutdown(wait=True)
+            self.pg_pool.closeall()
+            self.flush_raw_data()
             self.sqlite_conn.close()
 
 
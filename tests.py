@@ -1,6 +1,9 @@
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, call, patch
 from datetime import datetime
+import psycopg2
+import requests
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from dataCollector import DataCollector
 
 class TestDataCollector(unittest.TestCase):
@@ -14,11 +17,16 @@ class TestDataCollector(unittest.TestCase):
         self.sqlite_cursor_mock = Mock()
         
         self.postgres_mock.return_value.cursor.return_value = self.pg_cursor_mock
+        # Report pooled connections as open and idle so the pool keeps them
+        self.postgres_mock.return_value.closed = 0
+        self.postgres_mock.return_value.info.transaction_status = TRANSACTION_STATUS_IDLE
         self.sqlite_mock.return_value.cursor.return_value = self.sqlite_cursor_mock
+        self.sqlite_cursor_mock.fetchall.return_value = []
         
         self.collector = DataCollector()
 
     def tearDown(self):
+        self.collector.pg_writer.shutdown(wait=True)
         patch.stopall()
 
     def test_initialization(self):
@@ -26,6 +34,10 @@ class TestDataCollector(unittest.TestCase):
         self.assertEqual(self.collector.symbols, ["BTCUSDT", "ETHUSDT", "LTCBTC"])
         self.assertEqual(self.collector.sampling_frequency, 5) 
         self.assertEqual(self.collector.base_url, "https://api.binance.com/api/v3/ticker/price")
+        self.assertEqual(
+            self.collector.prices_url,
+            "https://api.binance.com/api/v3/ticker/price?symbols=%5B%22BTCUSDT%22%2C%22ETHUSDT%22%2C%22LTCBTC%22%5D"
+        )
         
         # Verify running metrics initialization
         for symbol in self.collector.symbols:
@@ -45,7 +57,8 @@ class TestDataCollector(unittest.TestCase):
             user="default",
             password="",
             host="localhost",
-            port="5432"
+            port="5432",
+            options="-c synchronous_commit=off"
         )
         self.sqlite_mock.assert_called_once_with('raw_data.db')
 
@@ -53,31 +66,60 @@ class TestDataCollector(unittest.TestCase):
         """Test SQLite database setup"""
         expected_query = '''
             CREATE TABLE IF NOT EXISTS raw_prices (
-                timestamp TEXT,
+                timestamp INTEGER,
                 symbol TEXT,
                 price REAL
             )
         '''
         self.sqlite_cursor_mock.execute.assert_called_with(expected_query)
+        self.sqlite_mock.return_value.execute.assert_any_call("PRAGMA journal_mode=WAL")
+        self.sqlite_mock.return_value.execute.assert_any_call("PRAGMA synchronous=NORMAL")
         self.sqlite_mock.return_value.commit.assert_called()
 
 
+    def test_setup_sqlite_db_recreates_text_timestamp_table(self):
+        """Test a raw_prices table from before epoch-ns timestamps is dropped and recreated"""
+        self.sqlite_cursor_mock.fetchall.return_value = [
+            (0, 'timestamp', 'TEXT', 0, None, 0),
+            (1, 'symbol', 'TEXT', 0, None, 0),
+            (2, 'price', 'REAL', 0, None, 0)
+        ]
+        self.sqlite_cursor_mock.execute.reset_mock()
+
+        self.collector.setup_sqlite_db()
+
+        self.sqlite_cursor_mock.execute.assert_any_call("DROP TABLE raw_prices")
+
+    def test_setup_sqlite_db_keeps_integer_timestamp_table(self):
+        """Test an up-to-date raw_prices table is left in place"""
+        self.sqlite_cursor_mock.fetchall.return_value = [
+            (0, 'timestamp', 'INTEGER', 0, None, 0),
+            (1, 'symbol', 'TEXT', 0, None, 0),
+            (2, 'price', 'REAL', 0, None, 0)
+        ]
+        self.sqlite_cursor_mock.execute.reset_mock()
+
+        self.collector.setup_sqlite_db()
+
+        self.assertNotIn(call("DROP TABLE raw_prices"), self.sqlite_cursor_mock.execute.call_args_list)
+
+
     def test_setup_postgres(self):
         """Test PostgreSQL database setup"""
         expected_query = '''
-            CREATE TABLE IF NOT EXISTS downsampled_prices (
-                date DATE,
-                hour INTEGER,
-                symbol TEXT,
-                open_price REAL,
-                high_price REAL,
-                low_price REAL,
-                close_price REAL,
-                avg_price REAL,
-                sample_count INTEGER,
-                PRIMARY KEY (date, hour, symbol)
-            )
-        '''
+                CREATE TABLE IF NOT EXISTS downsampled_prices (
+                    date DATE,
+                    hour INTEGER,
+                    symbol TEXT,
+                    open_price REAL,
+                    high_price REAL,
+                    low_price REAL,
+                    close_price REAL,
+                    avg_price REAL,
+                    sample_count INTEGER,
+                    PRIMARY KEY (date, hour, symbol)
+                )
+            '''
         self.pg_cursor_mock.execute.assert_called_with(expected_query)
         self.postgres_mock.return_value.commit.assert_called()
 
@@ -116,44 +158,131 @@ class TestDataCollector(unittest.TestCase):
         self.assertEqual(metrics['low_price'], 49000.00)
         self.assertEqual(metrics['avg_price'], sum(prices)/len(prices))
 
-    @patch('requests.get')
-    def test_fetch_prices_success(self, mock_get):
+    def test_fetch_prices_success(self):
         """Test successful price fetching"""
-        mock_responses = {
-            "BTCUSDT": {"price": "50000.00"},
-            "ETHUSDT": {"price": "3000.00"}
-        }
-        
-        def mock_get_side_effect(url):
-            symbol = url.split('=')[1]
-            mock_response = Mock()
-            mock_response.json.return_value = mock_responses[symbol]
-            mock_response.raise_for_status.return_value = None
-            return mock_response
+        mock_response = Mock()
+        mock_response.content = b'[{"symbol":"BTCUSDT","price":"50000.00"},{"symbol":"ETHUSDT","price":"3000.00"}]'
+        mock_response.raise_for_status.return_value = None
         
-        mock_get.side_effect = mock_get_side_effect
-        
-        results = self.collector.fetch_prices()
+        with patch.object(self.collector.session, 'get', return_value=mock_response) as mock_get, \
+             self.assertLogs('dataCollector', level='ERROR') as logs:
+            results = self.collector.fetch_prices()
         
+        self.assertEqual(logs.output, [
+            "ERROR:dataCollector:Error fetching price for LTCBTC: missing from bulk response"
+        ])
+        mock_get.assert_called_once_with(
+            self.collector.prices_url, timeout=self.collector.request_timeout
+        )
         self.assertEqual(len(results), 2)
         self.assertEqual(results[0]['symbol'], "BTCUSDT")
         self.assertEqual(results[0]['price'], 50000.00)
         self.assertEqual(results[1]['symbol'], "ETHUSDT")
         self.assertEqual(results[1]['price'], 3000.00)
+        self.assertIsInstance(results[0]['timestamp'], int)
+        self.assertEqual(results[0]['timestamp'], results[1]['timestamp'])
+
+    def test_fetch_prices_falls_back_to_per_symbol_requests(self):
+        """Test an invalid symbol rejecting the bulk request does not stop the other symbols"""
+        bulk_response = Mock(status_code=400, text='{"code":-1121,"msg":"Invalid symbol."}')
+
+        def symbol_response(content, error=None):
+            response = Mock(status_code=400 if error else 200, content=content)
+            response.raise_for_status.side_effect = error
+            return response
 
-    @patch('requests.get')
-    def test_fetch_prices_api_error(self, mock_get):
+        responses = {
+            self.collector.prices_url: bulk_response,
+            self.collector.symbol_urls["BTCUSDT"]: symbol_response(b'{"symbol":"BTCUSDT","price":"50000.00"}'),
+            self.collector.symbol_urls["ETHUSDT"]: symbol_response(b'{"symbol":"ETHUSDT","price":"3000.00"}'),
+            self.collector.symbol_urls["LTCBTC"]: symbol_response(b'', requests.HTTPError("400 Client Error"))
+        }
+
+        with patch.object(self.collector.session, 'get', side_effect=lambda url, timeout: responses[url]):
+            results = self.collector.fetch_prices()
+
+        self.assertEqual([result['symbol'] for result in results], ["BTCUSDT", "ETHUSDT"])
+        self.assertEqual(results[0]['price'], 50000.00)
+        self.assertEqual(self.collector.running_metrics["LTCBTC"]['sample_count'], 0)
+
+        # The rejected symbol is dropped, so later ticks are back to a single bulk request
+        self.assertEqual(self.collector.active_symbols, ["BTCUSDT", "ETHUSDT"])
+        self.assertEqual(
+            self.collector.prices_url,
+            "https://api.binance.com/api/v3/ticker/price?symbols=%5B%22BTCUSDT%22%2C%22ETHUSDT%22%5D"
+        )
+        bulk_ok = Mock(status_code=200, content=b'[{"symbol":"BTCUSDT","price":"50100.00"},{"symbol":"ETHUSDT","price":"3010.00"}]')
+        with patch.object(self.collector.session, 'get', return_value=bulk_ok) as mock_get:
+            results = self.collector.fetch_prices()
+
+        mock_get.assert_called_once_with(self.collector.prices_url, timeout=self.collector.request_timeout)
+        self.assertEqual([result['price'] for result in results], [50100.00, 3010.00])
+
+    def test_fetch_prices_switches_to_per_symbol_mode(self):
+        """Test a bulk rejection no single symbol explains stops further bulk requests"""
+        responses = {
+            self.collector.prices_url: Mock(status_code=400, text="Bad request"),
+            **{
+                url: Mock(status_code=200, content=f'{{"symbol":"{symbol}","price":"1.0"}}'.encode())
+                for symbol, url in self.collector.symbol_urls.items()
+            }
+        }
+
+        with patch.object(self.collector.session, 'get', side_effect=lambda url, timeout: responses[url]) as mock_get:
+            self.collector.fetch_prices()
+            mock_get.reset_mock()
+            results = self.collector.fetch_prices()
+
+        self.assertIsNone(self.collector.prices_url)
+        self.assertEqual(mock_get.call_count, len(self.collector.symbols))
+        self.assertEqual(len(results), 3)
+
+    def test_fetch_prices_api_error(self):
         """Test error handling in price fetching"""
-        mock_get.side_effect = Exception("API Error")
-        results = self.collector.fetch_prices()
+        with patch.object(self.collector.session, 'get', side_effect=Exception("API Error")):
+            results = self.collector.fetch_prices()
         self.assertEqual(len(results), 0)
 
 
+    def test_store_raw_data(self):
+        """Test raw data is buffered in memory without touching SQLite"""
+        timestamp = 1704067200000000000
+        raw_data = [
+            {'timestamp': timestamp, 'symbol': "BTCUSDT", 'price': 50000.00},
+            {'timestamp': timestamp, 'symbol': "ETHUSDT", 'price': 3000.00}
+        ]
+
+        self.collector.store_raw_data(raw_data)
+
+        self.assertEqual(self.collector.raw_buffer, [
+            (timestamp, "BTCUSDT", 50000.00),
+            (timestamp, "ETHUSDT", 3000.00)
+        ])
+        self.sqlite_mock.return_value.executemany.assert_not_called()
+
+    def test_flush_raw_data(self):
+        """Test buffered raw data is written to SQLite in a single batch"""
+        rows = [
+            (1704067200000000000, "BTCUSDT", 50000.00),
+            (1704067200000000000, "ETHUSDT", 3000.00)
+        ]
+        self.collector.raw_buffer = list(rows)
+
+        self.collector.flush_raw_data()
+
+        self.sqlite_mock.return_value.executemany.assert_called_once_with(
+            "INSERT INTO raw_prices (timestamp, symbol, price) VALUES (?, ?, ?)",
+            rows
+        )
+        self.sqlite_mock.return_value.commit.assert_called()
+        self.assertEqual(self.collector.raw_buffer, [])
+
     def test_clear_raw_data(self):
         """Test clearing raw data from SQLite"""
         self.collector.clear_raw_data()
         self.sqlite_cursor_mock.execute.assert_called_with("DELETE FROM raw_prices")
         self.sqlite_mock.return_value.commit.assert_called()
+        self.sqlite_mock.return_value.execute.assert_called_with("PRAGMA wal_checkpoint(PASSIVE)")
 
     def test_store_downsampled_data(self):
         """Test storing downsampled data in PostgreSQL"""
@@ -168,10 +297,72 @@ class TestDataCollector(unittest.TestCase):
         }
         
         self.collector.running_metrics['BTCUSDT'].update(test_metrics)
-        self.collector.store_downsampled_data(test_datetime)
+        with patch('dataCollector.execute_values') as execute_values_mock:
+            self.collector.store_downsampled_data(test_datetime)
         
-        self.pg_cursor_mock.execute.assert_called()
+        execute_values_mock.assert_called_once()
+        cursor, _, rows = execute_values_mock.call_args.args
+        self.assertIs(cursor, self.pg_cursor_mock)
+        self.assertEqual(rows, [(
+            test_datetime.date(), test_datetime.hour, "BTCUSDT",
+            49000.00, 51000.00, 48000.00, 50000.00, 49500.00, 10
+        )])
         self.postgres_mock.return_value.commit.assert_called()
+        self.postgres_mock.return_value.close.assert_not_called()
+
+    def test_store_downsampled_data_discards_broken_connection(self):
+        """Test a failed PostgreSQL write drops the connection instead of crashing"""
+        self.collector.running_metrics['BTCUSDT']['sample_count'] = 1
+        with patch('dataCollector.execute_values', side_effect=psycopg2.OperationalError("server closed")):
+            self.collector.store_downsampled_data(datetime.now())
+
+        self.postgres_mock.return_value.close.assert_called_once()
+        self.assertEqual(len(self.collector.retry_rows), 1)
+
+    def test_store_downsampled_data_reconnect_failure_retries_next_hour(self):
+        """Test a failed reconnect keeps the hour's rows and writes them with the next hour"""
+        first_hour = datetime(2024, 1, 1, 10)
+        second_hour = datetime(2024, 1, 1, 11)
+        self.collector.running_metrics['BTCUSDT']['sample_count'] = 1
+
+        with patch.object(self.collector.pg_pool, 'getconn', side_effect=psycopg2.OperationalError("connection refused")), \
+             patch.object(self.collector.pg_pool, 'putconn') as mock_putconn:
+            self.collector.store_downsampled_data(first_hour)
+
+        mock_putconn.assert_not_called()
+        self.assertEqual(len(self.collector.retry_rows), 1)
+
+        with patch('dataCollector.execute_values') as execute_values_mock:
+            self.collector.store_downsampled_data(second_hour)
+
+        retried, current = [call_args.args[2] for call_args in execute_values_mock.call_args_list]
+        self.assertEqual([(row[0], row[1]) for row in retried], [(first_hour.date(), 10)])
+        self.assertEqual([(row[0], row[1]) for row in current], [(second_hour.date(), 11)])
+        self.assertEqual(self.collector.retry_rows, [])
+
+    def test_store_downsampled_data_failed_retry_does_not_block_next_hour(self):
+        """Test retried rows failing on a data error are dropped without holding back the new hour"""
+        self.collector.retry_rows = [(datetime(2024, 1, 1).date(), 10, "BTCUSDT", 1, 1, 1, 1, 1, 1)]
+        self.collector.running_metrics['BTCUSDT']['sample_count'] = 1
+
+        with patch('dataCollector.execute_values',
+                   side_effect=[psycopg2.IntegrityError("duplicate key"), None]) as execute_values_mock:
+            self.collector.store_downsampled_data(datetime(2024, 1, 1, 11))
+
+        self.assertEqual(execute_values_mock.call_count, 2)
+        self.assertEqual(execute_values_mock.call_args.args[2][0][1], 11)
+        self.postgres_mock.return_value.rollback.assert_called()
+        self.postgres_mock.return_value.close.assert_not_called()
+        self.assertEqual(self.collector.retry_rows, [])
+
+    def test_store_downsampled_data_keeps_connection_on_data_error(self):
+        """Test a data error keeps the rows for retry but does not close a healthy connection"""
+        self.collector.running_metrics['BTCUSDT']['sample_count'] = 1
+        with patch('dataCollector.execute_values', side_effect=psycopg2.IntegrityError("duplicate key")):
+            self.collector.store_downsampled_data(datetime.now())
+
+        self.postgres_mock.return_value.close.assert_not_called()
+        self.assertEqual(len(self.collector.retry_rows), 1)
 
 
     def test_reset_running_metrics(self):
@@ -197,10 +388,95 @@ class TestDataCollector(unittest.TestCase):
             self.assertEqual(metrics['avg_price'], 0)
             self.assertEqual(metrics['sample_count'], 0)
 
+    @patch('time.sleep', side_effect=KeyboardInterrupt)
+    @patch('time.monotonic', side_effect=[100.0, 101.5])
+    def test_run_sleeps_until_next_tick(self, mock_monotonic, mock_sleep):
+        """Test the sampling period is not stretched by the time spent fetching"""
+        with patch.object(self.collector, 'fetch_prices', return_value=[]):
+            self.collector.run()
+
+        mock_sleep.assert_called_once_with(self.collector.sampling_frequency - 1.5)
+
+    def test_hourly_rollover_stores_snapshot_in_background(self):
+        """Test the finished hour is handed to the PostgreSQL writer and metrics are reset"""
+        self.collector.update_running_metrics("BTCUSDT", 50000.00, 1704103200000000000)
+
+        with patch.object(self.collector.pg_writer, 'submit') as mock_submit, \
+             patch.object(self.collector, 'clear_raw_data') as mock_clear:
+            self.collector.hourly_rollover(datetime(2024, 1, 1, 10))
+
+        mock_submit.assert_called_once()
+        func, hour_datetime, snapshot = mock_submit.call_args.args
+        self.assertEqual(func, self.collector.store_downsampled_data)
+        self.assertEqual(hour_datetime, datetime(2024, 1, 1, 10))
+        self.assertEqual(snapshot['BTCUSDT']['sample_count'], 1)
+        self.assertEqual(snapshot['BTCUSDT']['open_price'], 50000.00)
+        self.assertEqual(self.collector.running_metrics['BTCUSDT']['sample_count'], 0)
+        mock_clear.assert_not_called()
+
+    def test_hourly_rollover_logs_background_write_failure(self):
+        """Test an exception raised by the background PostgreSQL write is logged"""
+        with patch.object(self.collector, 'store_downsampled_data', side_effect=RuntimeError("pool exhausted")), \
+             self.assertLogs('dataCollector', level='ERROR') as logs:
+            self.collector.hourly_rollover(datetime(2024, 1, 1, 10))
+            self.collector.pg_writer.shutdown(wait=True)
+
+        self.assertIn("Error storing hourly metrics for hour 10: pool exhausted", logs.output[0])
+
+    def test_hourly_rollover_clears_raw_data_at_end_of_day(self):
+        """Test raw data is cleared once the last hour of the day is closed out"""
+        with patch.object(self.collector.pg_writer, 'submit'), \
+             patch.object(self.collector, 'clear_raw_data') as mock_clear:
+            self.collector.hourly_rollover(datetime(2024, 1, 1, 23))
+
+        mock_clear.assert_called_once()
+
+    @patch('time.sleep')
+    @patch('time.monotonic', side_effect=[100.0, 101.0, 106.0])
+    def test_run_rolls_over_when_hour_ends(self, mock_monotonic, mock_sleep):
+        """Test the rollover fires on the first tick past the end of the hour"""
+        with patch('dataCollector.datetime') as mock_datetime, \
+             patch.object(self.collector, 'hourly_rollover') as mock_rollover, \
+             patch.object(self.collector, 'fetch_prices', side_effect=[[], KeyboardInterrupt]):
+            mock_datetime.now.return_value = datetime(2024, 1, 1, 10, 59, 58)
+            self.collector.run()
+
+        mock_rollover.assert_called_once_with(datetime(2024, 1, 1, 10))
+        mock_sleep.assert_called_once_with(4.0)
+
+    @patch('time.sleep', side_effect=KeyboardInterrupt)
+    def test_run_logs_readable_sample_time(self, mock_sleep):
+        """Test the per-tick price log shows a readable time rather than epoch nanoseconds"""
+        timestamp = 1704067200123456789
+        prices = [
+            {'timestamp': timestamp, 'symbol': "BTCUSDT", 'price': 50000.00},
+            {'timestamp': timestamp, 'symbol': "ETHUSDT", 'price': 3000.00}
+        ]
+
+        with patch.object(self.collector, 'fetch_prices', return_value=prices), \
+             self.assertLogs('dataCollector', level='INFO') as logs:
+            self.collector.run()
+
+        sampled_at = datetime.fromtimestamp(timestamp // 10**9)
+        self.assertIn(f"INFO:dataCollector:BTCUSDT: $50000.00 at {sampled_at}", logs.output)
+        self.assertIn(f"INFO:dataCollector:ETHUSDT: $3000.00 at {sampled_at}", logs.output)
+
     def test_run_cleanup(self):
-        with patch.object(self.collector, 'fetch_prices', side_effect=KeyboardInterrupt):
+        self.collector.raw_buffer = [(1704067200000000000, "BTCUSDT", 50000.00)]
+        shutdown_order = Mock()
+        with patch.object(self.collector, 'fetch_prices', side_effect=KeyboardInterrupt), \
+             patch.object(self.collector.session, 'close') as session_close_mock, \
+             patch.object(self.collector.pg_writer, 'shutdown', wraps=self.collector.pg_writer.shutdown) as writer_shutdown_mock, \
+             patch.object(self.collector.pg_pool, 'closeall', wraps=self.collector.pg_pool.closeall) as closeall_mock:
+            shutdown_order.attach_mock(writer_shutdown_mock, 'writer_shutdown')
+            shutdown_order.attach_mock(closeall_mock, 'closeall')
             self.collector.run()
             
+        session_close_mock.assert_called_once()
+        # Pending hourly writes must finish before their connections are closed
+        self.assertEqual(shutdown_order.mock_calls, [call.writer_shutdown(wait=True), call.closeall()])
+        self.sqlite_mock.return_value.executemany.assert_called_once()
+        self.assertEqual(self.collector.raw_buffer, [])
         self.postgres_mock.return_value.close.assert_called()
         self.sqlite_mock.return_value.close.assert_called()
 